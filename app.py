@@ -1,8 +1,13 @@
-from flask import Flask, jsonify, request, render_template, send_file
+from flask import Flask, Response, jsonify, request, render_template, send_file
 from flask_cors import CORS
-import json, requests, tempfile, subprocess, os, threading, time
+import glob, json, orjson, re, requests, shutil, sqlite3, tempfile, subprocess, os, threading, time
+from functools import lru_cache
+from itertools import islice
 from concurrent.futures import ThreadPoolExecutor, Future
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache
 from dotenv import load_dotenv
 # ==========================
 # 1️⃣ Flask app + CORS
@@ -10,76 +15,312 @@ from dotenv import load_dotenv
 app = Flask(__name__)
 CORS(app)
 load_dotenv()
+
+# Opt-in when fronted by nginx/Apache that honours X-Sendfile, so cached
+# MP3 bytes are shipped by the proxy instead of looping through Python.
+# Must go through app.config: Flask 3.1 dropped the use_x_sendfile
+# attribute, and send_file only reads the config key
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE") == "1"
 # ==========================
 # 2️⃣ Load Google Drive keys
 # ==========================
-# 🔐 RECOMMENDED: use Railway ENV vars
-FOLDER_ID = os.getenv("FOLDER_ID")
-API_KEY   = os.getenv("GOOGLE_API_KEY")
-
-# ❗ fallback for local testing only
-if not FOLDER_ID or not API_KEY:
-    with open("keys.json", "r") as f:
-        keys = json.load(f)
-    FOLDER_ID = keys["folder_id"]
-    API_KEY   = keys["api_key"]
+@lru_cache(maxsize=None)
+def _drive_keys():
+    """Load (folder_id, api_key) lazily on first use, not at import."""
+    # 🔐 RECOMMENDED: use Railway ENV vars
+    folder_id = os.getenv("FOLDER_ID")
+    api_key = os.getenv("GOOGLE_API_KEY")
+
+    # ❗ fallback for local testing only
+    if not folder_id or not api_key:
+        with open("keys.json", "r") as f:
+            keys = json.load(f)
+        folder_id = keys["folder_id"]
+        api_key = keys["api_key"]
+
+    return folder_id, api_key
 
 GOOGLE_DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
 
+# 1 MiB download chunks: big enough to amortize requests' per-chunk overhead
+# and cut write() syscalls ~128x vs the old 8 KiB
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# (connect, read) timeout for every Drive API call
+REQUEST_TIMEOUT = (5, 60)
+
+# Shared session so Drive calls reuse TCP+TLS connections instead of
+# re-handshaking on every request
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.2,
+                      status_forcelist=(429, 500, 502, 503, 504)),
+))
+
 # ==========================
 # 3️⃣ Thread pool & cache
 # ==========================
-MAX_WORKERS = 4
-executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
-
-CACHE_DIR = Path(tempfile.gettempdir()) / "awb_mp3_cache"
+# Network-bound Drive work and CPU-bound ffmpeg encodes get separate
+# pools so slow sockets can't starve compute slots (or vice versa)
+NET_WORKERS = min(32, (os.cpu_count() or 2) * 4)
+CPU_WORKERS = max(1, os.cpu_count() or 2)
+
+net_exec = ThreadPoolExecutor(max_workers=NET_WORKERS)
+cpu_exec = ThreadPoolExecutor(max_workers=CPU_WORKERS)
+
+# Prefer /dev/shm (tmpfs) so cached MP3s live in RAM and os.replace is a
+# cheap same-filesystem rename; fall back to the regular temp dir
+if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+    CACHE_DIR = Path("/dev/shm/awb_mp3_cache")
+else:
+    CACHE_DIR = Path(tempfile.gettempdir()) / "awb_mp3_cache"
 CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
-ongoing: dict[str, Future] = {}
-ongoing_lock = threading.Lock()
+# Cap cache usage so a RAM-backed CACHE_DIR can't grow unbounded. Sized
+# against the actual filesystem: Docker's default /dev/shm is only
+# 64 MiB, and a fixed 512 MiB cap there would mean the tmpfs fills and
+# every conversion dies with ENOSPC before eviction ever triggers
+CACHE_MAX_BYTES = min(512 * 1024 * 1024,
+                      shutil.disk_usage(CACHE_DIR).total // 2)
+
+# Persistent index of cached MP3s, so restarts know what's already
+# converted and eviction is true LRU on access time, not file mtime.
+# Opened lazily so each gunicorn worker gets its own connection after
+# the fork — a connection inherited from a preloaded master must not be
+# shared. WAL mode keeps the concurrent per-worker writers safe.
+_DB_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _cache_db():
+    db = sqlite3.connect(str(CACHE_DIR / "index.sqlite"),
+                         check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS cache ("
+        " key TEXT PRIMARY KEY, size INTEGER, last_access INTEGER)")
+    _rebuild_cache_index(db)
+    return db
+
+
+def _touch_cache(key: str):
+    with _DB_LOCK:
+        _cache_db().execute(
+            "UPDATE cache SET last_access = strftime('%s','now') WHERE key = ?",
+            (key,))
+
+
+def _record_cache(key: str, size: int):
+    with _DB_LOCK:
+        _cache_db().execute(
+            "INSERT OR REPLACE INTO cache (key, size, last_access)"
+            " VALUES (?, ?, strftime('%s','now'))",
+            (key, size))
+
+
+def _rebuild_cache_index(db):
+    """Reconcile the index with what actually survived the restart."""
+    # .part files from a worker killed mid-conversion match neither the
+    # reconciliation glob nor any index row — sweep any old enough that
+    # no live conversion can still be writing them
+    cutoff = time.time() - 300
+    for p in CACHE_DIR.glob("*.part"):
+        try:
+            if p.stat().st_mtime < cutoff:
+                p.unlink()
+        except OSError:
+            pass
+
+    on_disk = {p.stem: p.stat().st_size for p in CACHE_DIR.glob("*_*.mp3")}
+    indexed = {k for (k,) in db.execute("SELECT key FROM cache")}
+    db.executemany("DELETE FROM cache WHERE key = ?",
+                   [(k,) for k in indexed - set(on_disk)])
+    db.executemany(
+        "INSERT OR REPLACE INTO cache (key, size, last_access)"
+        " VALUES (?, ?, strftime('%s','now'))",
+        [(k, size) for k, size in on_disk.items() if k not in indexed])
+
+# Resolve ffmpeg once at import so each spawn skips the PATH walk
+FFMPEG_BIN = shutil.which("ffmpeg") or "ffmpeg"
+FFPROBE_BIN = shutil.which("ffprobe") or "ffprobe"
+
+
+def _probe_stream(head: bytes):
+    """Identify (codec, container) from the first chunk of a source stream."""
+    p = subprocess.run(
+        [FFPROBE_BIN, "-v", "error", "-select_streams", "a:0",
+         "-show_entries", "stream=codec_name:format=format_name",
+         "-of", "default=nw=1:nk=1", "pipe:0"],
+        input=head, capture_output=True)
+    lines = p.stdout.decode().split()
+    codec = lines[0] if lines else ""
+    fmt = lines[1] if len(lines) > 1 else ""
+    return codec, fmt
+
+
+def _evict_cache():
+    """Delete least-recently-accessed MP3s until the cache fits the cap."""
+    victims = []
+    with _DB_LOCK:
+        db = _cache_db()
+        total = db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total > CACHE_MAX_BYTES:
+            for key, size in db.execute(
+                    "SELECT key, size FROM cache ORDER BY last_access"):
+                if total <= CACHE_MAX_BYTES:
+                    break
+                victims.append(key)
+                total -= size
+            db.executemany("DELETE FROM cache WHERE key = ?",
+                           [(k,) for k in victims])
+    for key in victims:
+        try:
+            (CACHE_DIR / f"{key}.mp3").unlink()
+        except OSError:
+            pass
+
+# In-flight conversions, sharded so concurrent /api/convert calls don't
+# all fight over one global lock; entries are removed by a done-callback
+_N_SHARDS = 16
+_SHARDS: list[dict[str, Future]] = [{} for _ in range(_N_SHARDS)]
+_SHARD_LOCKS = [threading.Lock() for _ in range(_N_SHARDS)]
+
+
+def _submit_or_join(key: str, fn, *args) -> Future:
+    """Return the in-flight Future for key, submitting fn if there is none."""
+    idx = hash(key) % _N_SHARDS
+    shard, lock = _SHARDS[idx], _SHARD_LOCKS[idx]
+    with lock:
+        fut = shard.get(key)
+        submitted = fut is None
+        if submitted:
+            fut = cpu_exec.submit(fn, *args)
+            shard[key] = fut
+
+    # Registered outside the shard lock: a Future that is already done
+    # runs its callback inline, which would self-deadlock on the
+    # non-reentrant lock. Popping a key that's already gone is harmless.
+    if submitted:
+        def _cleanup(_f):
+            with lock:
+                shard.pop(key, None)
+
+        fut.add_done_callback(_cleanup)
+    return fut
+
+# File listings cached per filter combination: only the first request in
+# each TTL window pays the full paginated Drive walk
+_LIST_CACHE = TTLCache(maxsize=64, ttl=60)
+_LIST_LOCK = threading.Lock()
+
+# Short-lived metadata cache, so a burst of requests for one file costs
+# a single Drive metadata call. TTLCache is not thread-safe, so every
+# read and write goes through _META_LOCK; the stripes only serialize the
+# Drive fetch itself, and stay a fixed array rather than one lock per
+# fileId, which would leak a Lock for every garbage ID ever requested
+_META_CACHE = TTLCache(maxsize=1024, ttl=30)
+_META_LOCK = threading.Lock()
+_META_LOCKS = [threading.Lock() for _ in range(64)]
 
 # ==========================
 # 4️⃣ Google Drive helpers
 # ==========================
+# Constant request params, memoized on first use so import needs no keys
+@lru_cache(maxsize=None)
+def _meta_params():
+    return {
+        "key": _drive_keys()[1],
+        "fields": "id,name,size,createdTime,modifiedTime,mimeType",
+    }
+
+
+@lru_cache(maxsize=None)
+def _list_params_base():
+    return {
+        "key": _drive_keys()[1],
+        "fields": "files(id,name,mimeType,size,createdTime,modifiedTime),nextPageToken",
+        "orderBy": "createdTime desc",
+        "pageSize": 1000,
+    }
+
+
+def _quote_term(value: str) -> str:
+    """Escape a user-supplied value for a single-quoted Drive query term."""
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
 def drive_file_metadata(file_id: str):
-    params = {"key": API_KEY, "fields": "id,name,size,createdTime,modifiedTime,mimeType"}
-    r = requests.get(f"{GOOGLE_DRIVE_FILES_URL}/{file_id}", params=params)
+    r = SESSION.get(f"{GOOGLE_DRIVE_FILES_URL}/{file_id}", params=_meta_params(), timeout=REQUEST_TIMEOUT)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
+
+
+def get_meta_cached(file_id: str):
+    with _META_LOCK:
+        meta = _META_CACHE.get(file_id)
+    if meta is not None:
+        return meta
+    with _META_LOCKS[hash(file_id) % len(_META_LOCKS)]:
+        with _META_LOCK:
+            meta = _META_CACHE.get(file_id)
+        if meta is None:
+            meta = drive_file_metadata(file_id)
+            with _META_LOCK:
+                _META_CACHE[file_id] = meta
+    return meta
 
 
 def drive_list_all_files(filters):
-    query = f"'{FOLDER_ID}' in parents and trashed = false"
+    key = (filters.get("type"), filters.get("name")) if filters else (None, None)
+
+    with _LIST_LOCK:
+        cached = _LIST_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    files = _fetch_all_files(filters)
+
+    with _LIST_LOCK:
+        _LIST_CACHE[key] = files
+    return files
+
+
+def _iter_drive_files(filters):
+    """Yield matching files lazily, one Drive page at a time."""
+    query = f"'{_drive_keys()[0]}' in parents and trashed = false"
 
     if filters:
         if "type" in filters:
-            query += f" and mimeType contains '{filters['type']}'"
+            query += f" and mimeType contains '{_quote_term(filters['type'])}'"
         if "name" in filters:
-            query += f" and name contains '{filters['name']}'"
+            query += f" and name contains '{_quote_term(filters['name'])}'"
 
-    params = {
-        "q": query,
-        "key": API_KEY,
-        "fields": "files(id,name,mimeType,size,createdTime,modifiedTime),nextPageToken",
-        "orderBy": "createdTime desc",
-        "pageSize": 1000
-    }
-
-    files = []
-    page_token = None
+    params = _list_params_base().copy()
+    params["q"] = query
 
-    while True:
-        if page_token:
-            params["pageToken"] = page_token
-        r = requests.get(GOOGLE_DRIVE_FILES_URL, params=params)
+    def fetch_page(token):
+        page_params = params if token is None else {**params, "pageToken": token}
+        r = SESSION.get(GOOGLE_DRIVE_FILES_URL, params=page_params, timeout=REQUEST_TIMEOUT)
         r.raise_for_status()
-        data = r.json()
-        files.extend(data.get("files", []))
+        return orjson.loads(r.content)
+
+    pending = net_exec.submit(fetch_page, None)
+
+    while pending is not None:
+        data = pending.result()
         page_token = data.get("nextPageToken")
-        if not page_token:
-            break
+        # Kick off the next page before touching this batch, so network
+        # latency overlaps with the Python-side work
+        pending = net_exec.submit(fetch_page, page_token) if page_token else None
+        yield from data.get("files", [])
 
-    return files
+
+def _fetch_all_files(filters):
+    return list(_iter_drive_files(filters))
 
 # ==========================
 # 5️⃣ API routes
@@ -101,31 +342,45 @@ def api_files():
     start = (page - 1) * page_size
     end = start + page_size
 
-    return jsonify({
+    # orjson.dumps is much faster than jsonify on large file-list payloads
+    return Response(orjson.dumps({
         "page": page,
         "pageSize": page_size,
         "total": total,
-        "files": all_files[start:end]
-    })
-
-
-def download_drive_file_to_temp(file_id: str) -> str:
-    url = f"{GOOGLE_DRIVE_FILES_URL}/{file_id}?alt=media&key={API_KEY}"
-    r = requests.get(url, stream=True)
-    r.raise_for_status()
-
-    tmp = tempfile.NamedTemporaryFile(delete=False)
-    for chunk in r.iter_content(8192):
-        tmp.write(chunk)
-    tmp.close()
-    return tmp.name
-
-
-def convert_awb_to_mp3(input_path, output_path):
-    cmd = ["ffmpeg", "-y", "-i", input_path, "-vn", "-ab", "192k", output_path]
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if p.returncode != 0:
-        raise RuntimeError(p.stderr.decode())
+        "files": list(islice(all_files, start, end))
+    }), mimetype="application/json")
+
+
+def _send_mp3(path):
+    # Plain full-file GETs hand the open file to wsgi.file_wrapper, which
+    # gunicorn's sync worker services with sendfile(2) — the MP3 bytes
+    # stay in the kernel instead of looping through Python under the GIL.
+    # When X-Sendfile is enabled the proxy does the copy instead, and only
+    # send_file knows how to emit the header, so skip the wrapper branch
+    if not app.config["USE_X_SENDFILE"] and not (
+            request.headers.get("Range")
+            or request.headers.get("If-Modified-Since")
+            or request.headers.get("If-None-Match")):
+        wrapper = request.environ.get("wsgi.file_wrapper")
+        if wrapper is not None:
+            f = open(path, "rb")
+            st = os.fstat(f.fileno())
+            resp = Response(wrapper(f, 1 << 18), mimetype="audio/mpeg",
+                            direct_passthrough=True)
+            resp.headers["Content-Length"] = str(st.st_size)
+            resp.headers["Accept-Ranges"] = "bytes"
+            # Hand out the same validators send_file would, so this
+            # client's next request can hit the conditional 304 path
+            resp.last_modified = st.st_mtime
+            resp.set_etag(f"{st.st_mtime}-{st.st_size}-{st.st_ino}")
+            return resp
+
+    # Range / conditional requests keep Flask's 206 and 304 handling
+    return send_file(path, mimetype="audio/mpeg", conditional=True)
+
+
+# Drive file IDs are URL-safe base64; anything else is rejected outright
+_FILE_ID_RE = re.compile(r"^[A-Za-z0-9_-]+$")
 
 
 def make_cache_key(file_id, modified_time):
@@ -134,23 +389,80 @@ def make_cache_key(file_id, modified_time):
 
 
 def convert_and_cache(file_id):
-    meta = drive_file_metadata(file_id)
+    meta = get_meta_cached(file_id)
     modified_time = meta.get("modifiedTime") or meta.get("createdTime")
 
     key = make_cache_key(file_id, modified_time)
     cached = CACHE_DIR / f"{key}.mp3"
 
     if cached.exists():
+        _touch_cache(key)
         return str(cached)
 
-    src = download_drive_file_to_temp(file_id)
-    try:
-        tmp_mp3 = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3").name
-        convert_awb_to_mp3(src, tmp_mp3)
-        os.replace(tmp_mp3, cached)
+    url = f"{GOOGLE_DRIVE_FILES_URL}/{file_id}?alt=media&key={_drive_keys()[1]}"
+    r = SESSION.get(url, stream=True, timeout=REQUEST_TIMEOUT)
+    r.raise_for_status()
+
+    # Pipe the download straight into ffmpeg's stdin: download and encode
+    # overlap, and the source never touches disk
+    chunks = r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+    head = next(chunks, b"")
+    codec, fmt = _probe_stream(head)
+
+    # Unique per attempt: gunicorn preforks workers with per-process
+    # in-flight maps, so two workers can convert the same fresh file at
+    # once — a shared .part name would interleave their writes into one
+    # inode. The .part suffix keeps the orphan sweep matching
+    part = f"{cached}.{os.getpid()}.{threading.get_ident()}.part"
+
+    # A bare MP3 file needs no ffmpeg at all — write the bytes through
+    # and skip the process spawn entirely
+    if fmt == "mp3":
+        with open(part, "wb") as out:
+            out.write(head)
+            for chunk in chunks:
+                out.write(chunk)
+        os.replace(part, cached)
+        _record_cache(key, cached.stat().st_size)
+        net_exec.submit(_evict_cache)
         return str(cached)
-    finally:
-        os.remove(src)
+
+    # MP3 audio in some other container is stream-copied (remux only);
+    # everything else pays the full decode + LAME re-encode
+    codec_args = ["-c:a", "copy"] if codec == "mp3" else ["-ab", "192k"]
+
+    cmd = [FFMPEG_BIN, "-y", "-hide_banner", "-nostats", "-loglevel", "error",
+           "-threads", "0", "-i", "pipe:0", "-vn", *codec_args, "-f", "mp3", part]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            bufsize=DOWNLOAD_CHUNK_SIZE)
+
+    # Drain stderr concurrently: if it were read only after the stdin
+    # loop, ffmpeg spamming decode errors could fill the 64 KiB pipe and
+    # stop consuming stdin, deadlocking this thread on write()
+    stderr_buf = []
+    drainer = threading.Thread(target=lambda: stderr_buf.append(proc.stderr.read()),
+                               daemon=True)
+    drainer.start()
+
+    try:
+        proc.stdin.write(head)
+        for chunk in chunks:
+            proc.stdin.write(chunk)
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass  # ffmpeg died early; its exit code tells the story
+
+    drainer.join()
+    if proc.wait() != 0:
+        if os.path.exists(part):
+            os.remove(part)
+        raise RuntimeError(b"".join(stderr_buf).decode())
+
+    os.replace(part, cached)
+    _record_cache(key, cached.stat().st_size)
+    net_exec.submit(_evict_cache)
+    return str(cached)
 
 
 @app.route("/api/convert")
@@ -158,27 +470,32 @@ def api_convert():
     file_id = request.args.get("fileId")
     if not file_id:
         return jsonify({"error": "fileId required"}), 400
-
-    meta = drive_file_metadata(file_id)
+    if not _FILE_ID_RE.fullmatch(file_id):
+        return jsonify({"error": "invalid fileId"}), 400
+
+    # Fast path: anything already converted for this file means no Drive
+    # round-trip at all — serve the newest cached MP3. IDs may contain
+    # "_", so check the stem really is this ID plus a timestamp (which
+    # never contains "_") and not a longer ID sharing the prefix
+    hits = sorted((p for p in CACHE_DIR.glob(glob.escape(file_id) + "_*.mp3")
+                   if "_" not in p.stem[len(file_id) + 1:]),
+                  key=lambda p: p.stat().st_mtime)
+    if hits:
+        _touch_cache(hits[-1].stem)
+        return _send_mp3(hits[-1])
+
+    meta = get_meta_cached(file_id)
     modified_time = meta.get("modifiedTime") or meta.get("createdTime")
 
     key = make_cache_key(file_id, modified_time)
     cached = CACHE_DIR / f"{key}.mp3"
 
     if cached.exists():
-        return send_file(cached, mimetype="audio/mpeg")
-
-    with ongoing_lock:
-        fut = ongoing.get(key)
-        if not fut:
-            fut = executor.submit(convert_and_cache, file_id)
-            ongoing[key] = fut
+        _touch_cache(key)
+        return _send_mp3(cached)
 
-    try:
-        return send_file(fut.result(), mimetype="audio/mpeg")
-    finally:
-        with ongoing_lock:
-            ongoing.pop(key, None)
+    fut = _submit_or_join(key, convert_and_cache, file_id)
+    return _send_mp3(fut.result())
 
 
 @app.route("/")
@@ -187,8 +504,8 @@ def index():
 
 
 # ==========================
-# 6️⃣ Railway entrypoint
+# 6️⃣ Local dev entrypoint — production runs gunicorn (Procfile/Dockerfile)
 # ==========================
 if __name__ == "__main__":
-    port = 5000
+    port = int(os.getenv("PORT", 5000))
     app.run(host="0.0.0.0", port=port)